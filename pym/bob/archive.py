@@ -21,29 +21,32 @@ concurrent uploads the artifact must appear atomically for unrelated readers.
 
 from . import BOB_VERSION
 from .errors import BuildError
-from .tty import stepAction, stepMessage, \
+from .tty import stepAction, stepMessage, isParallel, \
     SKIPPED, EXECUTED, WARNING, INFO, TRACE, ERROR, IMPORTANT
 from .utils import asHexStr, removePath, isWindows, sslNoVerifyContext, \
     getBashPath, tarfileOpen
 from shlex import quote
-from tempfile import mkstemp, NamedTemporaryFile, TemporaryFile, gettempdir
-import argparse
+from tempfile import mkstemp, NamedTemporaryFile, SpooledTemporaryFile, gettempdir
 import asyncio
 import base64
 import concurrent.futures
 import concurrent.futures.process
+import functools
 import gzip
 import hashlib
 import http.client
 import io
 import os
 import os.path
+import queue
 import shutil
 import signal
+import socket
 import ssl
 import subprocess
 import tarfile
-import textwrap
+import threading
+import time
 import urllib.parse
 
 ARCHIVE_GENERATION = '-1'
@@ -51,9 +54,66 @@ ARTIFACT_SUFFIX = ".tgz"
 BUILDID_SUFFIX = ".buildid"
 FINGERPRINT_SUFFIX = ".fprnt"
 
+# Chunk size for moving artifact data around
+COPY_BUFSIZE = 1024 * 1024
+
+# Artifacts up to this size are kept in memory before being uploaded. Bigger
+# ones are spilled to a temporary file.
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+# Seconds until a missing artifact is looked up again in the same archive
+NOT_FOUND_TTL = 60
+
+# Thread pool that is shared by all archive operations of the process. It is
+# created on first use.
+_threadPool = None
+_threadPoolLock = threading.Lock()
+
+def getThreadPool():
+    global _threadPool
+    with _threadPoolLock:
+        if _threadPool is None:
+            _threadPool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(32, (os.cpu_count() or 1) * 4),
+                thread_name_prefix="bob-archive")
+        return _threadPool
+
+def _resetThreadPool():
+    # The threads of the parent do not exist in a forked child
+    global _threadPool, _threadPoolLock
+    _threadPool = None
+    _threadPoolLock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_resetThreadPool)
+
+@functools.lru_cache(maxsize=None)
+def getPigzPath():
+    """Return path to pigz if available.
+
+    Pigz compresses on all cores and is used instead of the Python gzip module
+    when installed.
+    """
+    return shutil.which("pigz")
+
+@functools.lru_cache(maxsize=4096)
 def buildIdToName(bid):
     return asHexStr(bid) + ARCHIVE_GENERATION
 
+@functools.lru_cache(maxsize=4096)
+def buildIdToParts(bid):
+    """Split build-id into the directory levels and file name of archives."""
+    name = buildIdToName(bid)
+    return (name[0:2], name[2:4], name[4:])
+
+def copyToUploader(uploader, fileName):
+    with uploader as (name, fileobj):
+        if name is not None:
+            shutil.copyfile(fileName, name)
+        else:
+            with open(fileName, "rb") as f:
+                shutil.copyfileobj(f, fileobj, COPY_BUFSIZE)
+
 def readFileOrHandle(name, fileobj):
     if fileobj is not None:
         return fileobj.read()
@@ -131,44 +191,194 @@ class TarHelper:
         if tar.pax_headers.get('bob-archive-vsn', "0") != "1":
             raise BuildError("Unsupported binary artifact")
 
-        f = tar.next()
-        while f is not None:
-            if f.name.startswith("content/"):
-                if f.islnk():
-                    if not f.linkname.startswith("content/"):
-                        raise BuildError("invalid hard link in archive: '{}' -> '{}'"
-                                            .format(f.name, f.linkname))
-                    f.linkname = f.linkname[8:]
-                f.name = f.name[8:]
-                try:
-                    tar.extract(f, content)
-                except UnicodeError:
-                    raise BuildError("File name encoding error while extracting '{}'".format(f.name),
-                                     help="Your locale(7) probably does not (fully) support unicode.")
-            elif f.name == "meta/audit.json.gz":
-                with tar.extractfile(f) as audit_src:
-                    with open(audit, 'wb') as audit_dst:
-                        shutil.copyfileobj(audit_src, audit_dst)
-            elif f.name == "content" or f.name == "meta":
-                pass
-            else:
-                raise BuildError("Binary artifact contained unknown file: " + f.name)
+        with ParallelExtractor(tar, content) as extractor:
             f = tar.next()
+            while f is not None:
+                if f.name.startswith("content/"):
+                    if f.islnk():
+                        if not f.linkname.startswith("content/"):
+                            raise BuildError("invalid hard link in archive: '{}' -> '{}'"
+                                                .format(f.name, f.linkname))
+                        f.linkname = f.linkname[8:]
+                    f.name = f.name[8:]
+                    extractor.extract(f)
+                elif f.name == "meta/audit.json.gz":
+                    with tar.extractfile(f) as audit_src:
+                        with open(audit, 'wb') as audit_dst:
+                            shutil.copyfileobj(audit_src, audit_dst)
+                elif f.name == "content" or f.name == "meta":
+                    pass
+                else:
+                    raise BuildError("Binary artifact contained unknown file: " + f.name)
+                f = tar.next()
 
     def _extract(self, fileobj, audit, content):
-        with tarfileOpen(None, "r|*", fileobj=fileobj, errorlevel=1) as tar:
+        with tarfileOpen(None, "r|*", fileobj=fileobj, errorlevel=1,
+                         bufsize=COPY_BUFSIZE) as tar:
+            tar.copybufsize = COPY_BUFSIZE
             removePath(audit)
             removePath(content)
             os.makedirs(content)
             self.__extractPackage(tar, audit, content)
 
     def _pack(self, name, fileobj, audit, content):
-        pax = { 'bob-archive-vsn' : "1" }
+        pigz = getPigzPath()
+        if pigz is not None:
+            self.__packPigz(pigz, name, fileobj, audit, content)
+            return
+
+        # Stream into gzip. The tarfile "w|gz" mode would always compress
+        # with level 9 which is much slower for little gain.
         with gzip.open(name or fileobj, 'wb', 6) as gzf:
-            with tarfileOpen(name, "w", fileobj=gzf,
-                             format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
-                tar.add(audit, "meta/" + os.path.basename(audit))
-                tar.add(content, arcname="content")
+            self.__packTar(name, "w|", gzf, audit, content)
+
+    def __packTar(self, name, mode, fileobj, audit, content):
+        pax = { 'bob-archive-vsn' : "1" }
+        with tarfileOpen(name, mode, fileobj=fileobj, bufsize=COPY_BUFSIZE,
+                         format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
+            # The default of 16KiB makes the copy loop needlessly slow
+            tar.copybufsize = COPY_BUFSIZE
+            tar.add(audit, "meta/" + os.path.basename(audit))
+            tar.add(content, arcname="content")
+
+    def __packPigz(self, pigz, name, fileobj, audit, content):
+        """Pack artifact and compress it with pigz on all cores.
+
+        The compressed output is copied by a separate thread into the
+        destination, which might be an arbitrary file object.
+        """
+        proc = subprocess.Popen([pigz, "-6", "-c"], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        copyError = None
+
+        def copy():
+            nonlocal copyError
+            try:
+                if fileobj is not None:
+                    shutil.copyfileobj(proc.stdout, fileobj, COPY_BUFSIZE)
+                else:
+                    with open(name, "wb") as f:
+                        shutil.copyfileobj(proc.stdout, f, COPY_BUFSIZE)
+            except BaseException as e:
+                copyError = e
+                proc.kill() # unblock the writer
+            finally:
+                proc.stdout.close()
+
+        copier = threading.Thread(target=copy)
+        copier.start()
+        try:
+            self.__packTar(None, "w|", proc.stdin, audit, content)
+            proc.stdin.close()
+        except OSError:
+            # A broken pipe is just the consequence of a failed copy
+            if copyError is None: raise
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+            copier.join()
+            ret = proc.wait()
+
+        if copyError is not None:
+            raise copyError
+        if ret != 0:
+            raise OSError("pigz returned with status {}".format(ret))
+
+
+class ParallelExtractor:
+    """Extract tar members with multiple threads.
+
+    Extracting many small files is dominated by the latency of creating them
+    on the file system. The tar stream can only be read sequentially, though.
+    Hence the data of small regular files is read in the calling thread and
+    the files are written by a thread pool. Everything else is extracted
+    directly by the tarfile module.
+    """
+
+    MAX_FILE_SIZE = 1024 * 1024
+    MAX_PENDING = 32
+
+    def __init__(self, tar, path):
+        self.__tar = tar
+        self.__path = path
+        self.__pool = getThreadPool()
+        self.__slots = threading.BoundedSemaphore(ParallelExtractor.MAX_PENDING)
+        self.__pending = {}
+        self.__dirs = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            concurrent.futures.wait(self.__pending.values())
+        return False
+
+    def extract(self, member):
+        # Hard links need their target and a file must not be written twice
+        # concurrently.
+        if member.islnk() or member.name in self.__pending:
+            self.flush()
+
+        try:
+            if member.isreg() and member.size <= ParallelExtractor.MAX_FILE_SIZE:
+                self.__extractAsync(member)
+            else:
+                self.__tar.extract(member, self.__path)
+        except UnicodeError:
+            raise self.__unicodeError(member)
+
+    def flush(self):
+        """Wait for all pending files to be written."""
+        pending = self.__pending
+        self.__pending = {}
+        for f in pending.values():
+            f.result()
+
+    def __extractAsync(self, member):
+        member = self.__tar.extraction_filter(member, self.__path)
+        if member is None:
+            return
+        target = os.path.join(self.__path, member.name)
+        upperDir = os.path.dirname(target)
+        if upperDir not in self.__dirs:
+            os.makedirs(upperDir, exist_ok=True)
+            self.__dirs.add(upperDir)
+
+        with self.__tar.extractfile(member) as f:
+            data = f.read()
+        self.__slots.acquire()
+        try:
+            self.__pending[member.name] = self.__pool.submit(self.__write,
+                                                             member, target, data)
+        except:
+            self.__slots.release()
+            raise
+
+    def __write(self, member, target, data):
+        try:
+            with open(target, "wb") as f:
+                f.write(data)
+            try:
+                self.__tar.chown(member, target, False)
+                self.__tar.chmod(member, target)
+                self.__tar.utime(member, target)
+            except tarfile.ExtractError:
+                # Non-fatal like in TarFile.extract()
+                if self.__tar.errorlevel > 1: raise
+        except UnicodeError:
+            raise self.__unicodeError(member)
+        finally:
+            self.__slots.release()
+
+    @staticmethod
+    def __unicodeError(member):
+        return BuildError("File name encoding error while extracting '{}'".format(member.name),
+                          help="Your locale(7) probably does not (fully) support unicode.")
 
 
 class JenkinsArchive(TarHelper):
@@ -284,6 +494,11 @@ class JenkinsArchive(TarHelper):
         except OSError as e:
             raise BuildError("Cannot cache artifact: " + str(e))
 
+    def cachePackageFile(self, buildId, workspace, fileName):
+        helper = self.cachePackage(buildId, workspace)
+        if helper is not None:
+            copyToUploader(helper, fileName)
+
     async def uploadLocalLiveBuildId(self, step, liveBuildId, buildId, executor=None):
         pass
 
@@ -337,6 +552,16 @@ class BaseArchive(TarHelper):
         self.__wantDownloadJenkins = False
         self.__wantUploadLocal = False
         self.__wantUploadJenkins = False
+        self.__existingPackages = set()
+        self.__missingPackages = {}
+
+    def __getstate__(self):
+        # The existence caches are only maintained in the main process. Don't
+        # pickle them for every transfer that is done in the executor.
+        state = self.__dict__.copy()
+        state["_BaseArchive__existingPackages"] = set()
+        state["_BaseArchive__missingPackages"] = {}
+        return state
 
     @property
     def ignoreErrors(self):
@@ -377,10 +602,19 @@ class BaseArchive(TarHelper):
         suffix = ARTIFACT_SUFFIX
         details = " from {}".format(self._remoteName(buildId, suffix))
         with stepAction(step, "DOWNLOAD", content, details=details) as a:
+            missingSince = self.__missingPackages.get(buildId)
+            if missingSince is not None and time.monotonic() - missingSince < NOT_FOUND_TTL:
+                a.fail("not found", WARNING)
+                return False
             try:
                 ret, msg, kind = await loop.run_in_executor(executor, BaseArchive._downloadPackage,
                     self, buildId, suffix, audit, content, caches, step.getWorkspacePath())
-                if not ret: a.fail(msg, kind)
+                if ret:
+                    self.__existingPackages.add(buildId)
+                else:
+                    if msg == "not found":
+                        self.__missingPackages[buildId] = time.monotonic()
+                    a.fail(msg, kind)
                 return ret
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Download of package interrupted.")
@@ -396,15 +630,22 @@ class BaseArchive(TarHelper):
             else:
                 raise BuildError("Cannot cache artifact: " + str(e))
 
+    def cachePackageFile(self, buildId, workspace, fileName):
+        uploader = self.cachePackage(buildId, workspace)
+        if uploader is not None:
+            copyToUploader(uploader, fileName)
+
     def _downloadPackage(self, buildId, suffix, audit, content, caches, workspace):
         # Set default signal handler so that KeyboardInterrupt is raised.
         # Needed to gracefully handle ctrl+c.
         signal.signal(signal.SIGINT, signal.default_int_handler)
 
         try:
-            with self._openDownloadFile(buildId, suffix) as (name, fileobj):
+            downloader = self._openDownloadFile(buildId, suffix)
+            with downloader as (name, fileobj):
                 with Tee(name, fileobj, buildId, caches, workspace) as fo:
-                    self._extract(fo, audit, content)
+                    with ReadAheadReader(fo, getattr(downloader, "abort", None)) as ra:
+                        self._extract(ra, audit, content)
             return (True, None, None)
         except ArtifactNotFoundError:
             return (False, "not found", WARNING)
@@ -472,9 +713,15 @@ class BaseArchive(TarHelper):
         suffix = ARTIFACT_SUFFIX
         details = " to {}".format(self._remoteName(buildId, suffix))
         with stepAction(step, "UPLOAD", content, details=details) as a:
+            if buildId in self.__existingPackages:
+                a.setResult("skipped ({} exists in archive)".format(content), SKIPPED)
+                return
             try:
                 msg, kind = await loop.run_in_executor(executor, BaseArchive._uploadPackage,
                     self, buildId, suffix, audit, content)
+                if kind in (EXECUTED, SKIPPED):
+                    self.__existingPackages.add(buildId)
+                    self.__missingPackages.pop(buildId, None)
                 a.setResult(msg, kind)
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Upload of package interrupted.")
@@ -560,6 +807,92 @@ class BaseArchive(TarHelper):
                 raise BuildError("Download of fingerprint interrupted.")
 
 
+class ReadAheadReader:
+    """Read a file object in a background thread.
+
+    Overlaps the transfer of an artifact with its decompression and
+    extraction. The file is always read until the end on regular termination
+    so that mirrors see the whole artifact. On errors the optional ``abort``
+    callback is invoked to unblock a pending read of the thread, e.g. from a
+    stalled server.
+    """
+
+    QUEUE_SIZE = 8
+
+    def __init__(self, fileobj, abort=None):
+        self.__file = fileobj
+        self.__abort = abort
+        self.__queue = queue.Queue(ReadAheadReader.QUEUE_SIZE)
+        self.__buf = b""
+        self.__eof = False
+        self.__error = None
+        self.__stop = False
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            while not self.__eof:
+                self.__fill()
+            self.__thread.join()
+            if self.__error is not None:
+                raise self.__error
+        else:
+            # The thread must not touch the file anymore when we return.
+            self.__stop = True
+            if self.__abort is not None:
+                self.__abort()
+            self.__thread.join()
+        return False
+
+    def __run(self):
+        try:
+            while not self.__stop:
+                data = self.__file.read(COPY_BUFSIZE)
+                if not self.__put(data) or not data: break
+        except BaseException as e:
+            self.__put(e)
+
+    def __put(self, item):
+        while not self.__stop:
+            try:
+                self.__queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __fill(self):
+        item = self.__queue.get()
+        if isinstance(item, BaseException):
+            self.__eof = True
+            self.__error = item
+        elif not item:
+            self.__eof = True
+        elif self.__buf:
+            self.__buf += item
+        else:
+            self.__buf = item
+
+    def read(self, size=-1):
+        while not self.__eof and (size < 0 or len(self.__buf) < size):
+            self.__fill()
+        if self.__error is not None:
+            raise self.__error
+        if size < 0 or size >= len(self.__buf):
+            ret = self.__buf
+            self.__buf = b""
+        else:
+            ret = self.__buf[:size]
+            self.__buf = self.__buf[size:]
+        return ret
+
+    def close(self):
+        pass
+
 class Tee:
     def __init__(self, fileName, fileObj, buildId, caches, workspace):
         if fileObj is not None:
@@ -570,6 +903,17 @@ class Tee:
             self.__owner = True
 
         self.__caches = []
+        self.__fileCaches = []
+        if fileName is not None:
+            # The artifact is available as local file. Store it in the caches
+            # as a whole after it was extracted successfully. Saves passing
+            # all data through Python and the caches might even link it.
+            self.__fileName = fileName
+            self.__buildId = buildId
+            self.__workspace = workspace
+            self.__fileCaches = caches
+            return
+
         try:
             for c in caches:
                 mirror = c.cachePackage(buildId, workspace)
@@ -595,6 +939,15 @@ class Tee:
                     except (ArtifactUploadError, OSError) as e:
                         if not c.ignoreErrors:
                             raise BuildError("Cannot cache artifact: " + str(e))
+                for c in self.__fileCaches:
+                    try:
+                        c.cachePackageFile(self.__buildId, self.__workspace,
+                                           self.__fileName)
+                    except ArtifactExistsError:
+                        pass
+                    except (ArtifactUploadError, OSError) as e:
+                        if not c.ignoreErrors:
+                            raise BuildError("Cannot cache artifact: " + str(e))
         finally:
             for c in self.__caches: c.abort()
         return False
@@ -646,6 +999,10 @@ class MirrorLeecher:
 
 
 class LocalArchive(BaseArchive):
+    # Directories that are known to exist. Shared by all instances of the
+    # process because the archive is pickled for every transfer.
+    knownDirs = set()
+
     def __init__(self, spec):
         super().__init__(spec)
         self.__basePath = os.path.abspath(os.path.expanduser(spec["path"]))
@@ -653,11 +1010,9 @@ class LocalArchive(BaseArchive):
         self.__dirMode = spec.get("directoryMode")
 
     def _getPath(self, buildId, suffix):
-        packageResultId = buildIdToName(buildId)
-        packageResultPath = os.path.join(self.__basePath, packageResultId[0:2],
-                                         packageResultId[2:4])
-        packageResultFile = os.path.join(packageResultPath,
-                                         packageResultId[4:]) + suffix
+        (level1, level2, name) = buildIdToParts(buildId)
+        packageResultPath = os.path.join(self.__basePath, level1, level2)
+        packageResultFile = os.path.join(packageResultPath, name) + suffix
         return (packageResultPath, packageResultFile)
 
     def _remoteName(self, buildId, suffix):
@@ -665,10 +1020,28 @@ class LocalArchive(BaseArchive):
 
     def _openDownloadFile(self, buildId, suffix):
         (packageResultPath, packageResultFile) = self._getPath(buildId, suffix)
-        if os.path.isfile(packageResultFile):
-            return LocalArchiveDownloader(packageResultFile)
-        else:
-            raise ArtifactNotFoundError()
+        return LocalArchiveDownloader(packageResultFile)
+
+    def cachePackageFile(self, buildId, workspace, fileName):
+        # Try to just link the artifact. This fails across file systems and
+        # the link would share the file mode with the source.
+        if self.__fileMode is None and not isWindows():
+            (packageResultPath, packageResultFile) = self._getPath(buildId, ARTIFACT_SUFFIX)
+            try:
+                if packageResultPath not in LocalArchive.knownDirs:
+                    self.__makeDirs(packageResultPath)
+                os.link(fileName, packageResultFile)
+                return
+            except FileExistsError:
+                return
+            except OSError:
+                pass
+
+        # Fall back to a copy. On Linux this is done in the kernel.
+        uploader = self.cachePackage(buildId, workspace)
+        if uploader is not None:
+            with uploader as (_, tmp):
+                shutil.copyfile(fileName, tmp.name)
 
     def _openUploadFile(self, buildId, suffix, overwrite):
         (packageResultPath, packageResultFile) = self._getPath(buildId, suffix)
@@ -676,26 +1049,40 @@ class LocalArchive(BaseArchive):
             raise ArtifactExistsError()
 
         # open temporary file in destination directory
-        if not os.path.isdir(packageResultPath):
+        if packageResultPath not in LocalArchive.knownDirs:
+            self.__makeDirs(packageResultPath)
+        try:
+            tmp = NamedTemporaryFile(dir=packageResultPath, delete=False)
+        except FileNotFoundError:
+            # directory was removed in the meantime
+            self.__makeDirs(packageResultPath)
+            tmp = NamedTemporaryFile(dir=packageResultPath, delete=False)
+        return LocalArchiveUploader(tmp, self.__fileMode, packageResultFile,
+                                    overwrite)
+
+    def __makeDirs(self, path):
+        if not os.path.isdir(path):
             if self.__dirMode is not None:
                 oldMask = os.umask(~self.__dirMode & 0o777)
             try:
-                os.makedirs(packageResultPath, exist_ok=True)
+                os.makedirs(path, exist_ok=True)
             finally:
                 if self.__dirMode is not None:
                     os.umask(oldMask)
-        return LocalArchiveUploader(
-            NamedTemporaryFile(dir=packageResultPath, delete=False),
-            self.__fileMode, packageResultFile, overwrite)
+        LocalArchive.knownDirs.add(path)
 
 class LocalArchiveDownloader:
     def __init__(self, name):
+        # Just try to open the file instead of checking upfront. This saves
+        # a stat() call which is expensive on network file systems.
         try:
             self.fd = open(name, "rb")
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            raise ArtifactNotFoundError()
         except OSError as e:
             raise ArtifactDownloadError(str(e))
     def __enter__(self):
-        return (None, self.fd)
+        return (self.fd.name, self.fd)
     def __exit__(self, exc_type, exc_value, traceback):
         self.fd.close()
         return False
@@ -737,12 +1124,33 @@ class LocalArchiveUploader:
         return False
 
 
+# Idle HTTP connections of this process, indexed by server. Archive objects
+# are pickled into the worker processes for every single transfer. Keeping the
+# connections here lets consecutive transfers reuse them instead of opening a
+# new TCP (and TLS) connection for every artifact.
+_httpConnections = {}
+_httpConnectionsLock = threading.Lock()
+
 class SimpleHttpArchive(BaseArchive):
+    # Remember collections that were created on the servers
+    knownDirs = set()
+
     def __init__(self, spec):
         super().__init__(spec)
         self.__url = urllib.parse.urlparse(spec["url"])
         self.__connection = None
         self.__sslVerify = spec.get("sslVerify", True)
+        self.__chunkedUpload = spec.get("chunkedUpload", False)
+        self.__timeout = spec.get("timeout")
+        self.__poolKey = (self.__url.scheme, self.__url.hostname,
+                          self.__url.port, self.__sslVerify, self.__timeout)
+        self.__headers = { 'User-Agent' : 'BobBuildTool/{}'.format(BOB_VERSION) }
+        if self.__url.username is not None:
+            username = urllib.parse.unquote(self.__url.username)
+            passwd = urllib.parse.unquote(self.__url.password)
+            userPass = username + ":" + passwd
+            self.__headers['Authorization'] = 'Basic ' + base64.b64encode(
+                userPass.encode("utf-8")).decode("ascii")
 
     def __retry(self, request):
         retry = True
@@ -751,13 +1159,16 @@ class SimpleHttpArchive(BaseArchive):
                 return (True, request())
             except (http.client.HTTPException, OSError) as e:
                 self._resetConnection()
+                # Other idle connections to the server are probably stale too.
+                with _httpConnectionsLock:
+                    for c in _httpConnections.pop(self.__poolKey, []):
+                        c.close()
                 if not retry: return (False, e)
                 retry = False
 
     def _makeUrl(self, buildId, suffix):
-        packageResultId = buildIdToName(buildId)
-        return "/".join([self.__url.path, packageResultId[0:2], packageResultId[2:4],
-            packageResultId[4:] + suffix])
+        (level1, level2, name) = buildIdToParts(buildId)
+        return "/".join([self.__url.path, level1, level2, name + suffix])
 
     def _remoteName(self, buildId, suffix):
         url = self.__url
@@ -767,13 +1178,23 @@ class SimpleHttpArchive(BaseArchive):
         if self.__connection is not None:
             return self.__connection
 
+        with _httpConnectionsLock:
+            idle = _httpConnections.get(self.__poolKey)
+            if idle:
+                self.__connection = idle.pop()
+                return self.__connection
+
         url = self.__url
         if url.scheme == 'http':
-            connection = http.client.HTTPConnection(url.hostname, url.port)
+            connection = http.client.HTTPConnection(url.hostname, url.port,
+                                                    timeout=self.__timeout,
+                                                    blocksize=COPY_BUFSIZE)
         elif url.scheme == 'https':
             ctx = None if self.__sslVerify else sslNoVerifyContext()
             connection = http.client.HTTPSConnection(url.hostname, url.port,
-                                                     context=ctx)
+                                                     context=ctx,
+                                                     timeout=self.__timeout,
+                                                     blocksize=COPY_BUFSIZE)
         else:
             raise BuildError("Unsupported URL scheme: '{}'".format(url.schema))
 
@@ -785,15 +1206,18 @@ class SimpleHttpArchive(BaseArchive):
             self.__connection.close()
             self.__connection = None
 
+    def _releaseConnection(self):
+        """Put connection back into the pool.
+
+        Must only be called after the last response was read completely.
+        """
+        if self.__connection is not None:
+            with _httpConnectionsLock:
+                _httpConnections.setdefault(self.__poolKey, []).append(self.__connection)
+            self.__connection = None
+
     def _getHeaders(self):
-        headers = { 'User-Agent' : 'BobBuildTool/{}'.format(BOB_VERSION) }
-        if self.__url.username is not None:
-            username = urllib.parse.unquote(self.__url.username)
-            passwd = urllib.parse.unquote(self.__url.password)
-            userPass = username + ":" + passwd
-            headers['Authorization'] = 'Basic ' + base64.b64encode(
-                userPass.encode("utf-8")).decode("ascii")
-        return headers
+        return self.__headers.copy()
 
     def _openDownloadFile(self, buildId, suffix):
         (ok, result) = self.__retry(lambda: self.__openDownloadFile(buildId, suffix))
@@ -806,11 +1230,15 @@ class SimpleHttpArchive(BaseArchive):
         connection = self._getConnection()
         url = self._makeUrl(buildId, suffix)
         connection.request("GET", url, headers=self._getHeaders())
+        # The connection might drop the socket if the server closes the
+        # connection after the response.
+        sock = connection.sock
         response = connection.getresponse()
         if response.status == 200:
-            return SimpleHttpDownloader(self, response)
+            return SimpleHttpDownloader(self, response, sock)
         else:
             response.read()
+            self._releaseConnection()
             if response.status == 404:
                 raise ArtifactNotFoundError()
             else:
@@ -833,11 +1261,15 @@ class SimpleHttpArchive(BaseArchive):
             connection.request("HEAD", url, headers=self._getHeaders())
             response = connection.getresponse()
             response.read()
+            self._releaseConnection()
             if response.status == 200:
                 raise ArtifactExistsError()
             elif response.status != 404:
                 raise ArtifactUploadError("HEAD {} {}".format(response.status, response.reason))
 
+        if self.__chunkedUpload:
+            return SimpleHttpStreamUploader(self, url, overwrite)
+
         # create temporary file
         return SimpleHttpUploader(self, url, overwrite)
 
@@ -857,26 +1289,65 @@ class SimpleHttpArchive(BaseArchive):
         #
         # We don't want to waste bandwith by uploading big artifacts into a
         # missing directory. Thus make sure the directory always exists.
-        self.__makeParentDirs(url)
+        # Collections that were created before are remembered to save the
+        # round trips. Should one have been removed behind our back, the PUT
+        # fails with a 409 and is retried after creating it again.
+        known = (self.__poolKey, url.rpartition("/")[0]) in SimpleHttpArchive.knownDirs
+        if not known:
+            self.__makeParentDirs(url)
 
         # Determine file length outself and add a "Content-Length" header. This
-        # used to work in Python 3.5 automatically but was removed later.
+        # used to work in Python 3.5 automatically but was removed later. The
+        # file is then streamed by http.client in chunks of COPY_BUFSIZE.
         tmp.seek(0, os.SEEK_END)
         length = str(tmp.tell())
         tmp.seek(0)
         headers = self._getHeaders()
         headers.update({ 'Content-Length' : length })
+        if not self.__put(url, tmp, headers, overwrite, known):
+            self.__makeParentDirs(url)
+            tmp.seek(0)
+            self.__put(url, tmp, headers, overwrite)
+
+    def _putUploadStream(self, url, stream, overwrite):
+        # See __putUploadFile() why the directories are created upfront. This
+        # also makes sure that we start with a working connection because the
+        # stream cannot be rewound if the PUT needs to be retried. For the
+        # same reason it is done even if the collection is known to exist.
+        (ok, result) = self.__retry(lambda: self.__makeParentDirs(url))
+        if not ok:
+            raise ArtifactUploadError(str(result))
+
+        # Without a Content-Length header the stream is sent with chunked
+        # transfer encoding. The connection must be dropped if the request
+        # was interrupted, e.g. because the packing was aborted.
+        try:
+            self.__put(url, stream, self._getHeaders(), overwrite)
+        except (http.client.HTTPException, OSError) as e:
+            self._resetConnection()
+            raise ArtifactUploadError(str(e))
+        except:
+            self._resetConnection()
+            raise
+
+    def __put(self, url, body, headers, overwrite, retry=False):
         if not overwrite:
             headers.update({ 'If-None-Match' : '*' })
         connection = self._getConnection()
-        connection.request("PUT", url, tmp, headers=headers)
+        connection.request("PUT", url, body, headers=headers)
         response = connection.getresponse()
         response.read()
+        self._releaseConnection()
         if response.status == 412:
             # precondition failed -> lost race with other upload
             raise ArtifactExistsError()
+        elif response.status == 409 and retry:
+            # parent collection vanished -> caller creates it again
+            SimpleHttpArchive.knownDirs.discard((self.__poolKey, url.rpartition("/")[0]))
+            return False
         elif response.status not in [200, 201, 204]:
             raise ArtifactUploadError("PUT {} {}".format(response.status, response.reason))
+        return True
 
     def __makeParentDirs(self, url, depth=0):
         """Create parent directories.
@@ -899,6 +1370,7 @@ class SimpleHttpArchive(BaseArchive):
         # for the best...
         if response.status not in [201, 405]:
             raise ArtifactUploadError("MKCOL {} {}".format(response.status, response.reason))
+        SimpleHttpArchive.knownDirs.add((self.__poolKey, dirs))
 
     def __mkcol(self, url):
         # MKCOL resources must have a trailing slash because they are
@@ -910,24 +1382,35 @@ class SimpleHttpArchive(BaseArchive):
         connection.request("MKCOL", url, headers=self._getHeaders())
         response = connection.getresponse()
         response.read()
+        self._releaseConnection()
         return response
 
 class SimpleHttpDownloader:
-    def __init__(self, archiver, response):
+    def __init__(self, archiver, response, sock):
         self.archiver = archiver
         self.response = response
+        self.sock = sock
     def __enter__(self):
         return (None, self.response)
+    def abort(self):
+        """Unblock a pending read of the response from another thread."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
     def __exit__(self, exc_type, exc_value, traceback):
-        # reset connection on abnormal termination
-        if exc_type is not None:
+        # The response was read completely on success. Keep the connection
+        # alive in this case. Otherwise it must be dropped.
+        if exc_type is None and self.response.isclosed():
+            self.archiver._releaseConnection()
+        else:
             self.archiver._resetConnection()
         return False
 
 class SimpleHttpUploader:
     def __init__(self, archiver, url, overwrite):
         self.archiver = archiver
-        self.tmp = TemporaryFile()
+        self.tmp = SpooledTemporaryFile(SPOOL_MAX_SIZE)
         self.url = url
         self.overwrite = overwrite
     def __enter__(self):
@@ -941,6 +1424,70 @@ class SimpleHttpUploader:
             self.tmp.close()
         return False
 
+class SimpleHttpStreamUploader:
+    """Upload artifact while it is packed.
+
+    The packed artifact is passed through a pipe to a thread that sends it
+    with chunked transfer encoding. This saves writing the whole artifact to a
+    temporary file and reading it back again.
+    """
+
+    def __init__(self, archiver, url, overwrite):
+        self.archiver = archiver
+        self.url = url
+        self.overwrite = overwrite
+
+    def __enter__(self):
+        (r, w) = os.pipe()
+        self.reader = SimpleHttpStreamReader(os.fdopen(r, "rb"))
+        self.writer = os.fdopen(w, "wb")
+        self.error = None
+        self.thread = threading.Thread(target=self.__upload)
+        self.thread.start()
+        return (None, self.writer)
+
+    def __upload(self):
+        try:
+            self.archiver._putUploadStream(self.url, self.reader, self.overwrite)
+        except BaseException as e:
+            self.error = e
+        finally:
+            # Unblocks the writer if the upload failed prematurely
+            self.reader.close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The server must not see a regular end of the upload if the packing
+        # failed. Otherwise a truncated artifact would be stored.
+        if exc_type is not None:
+            self.reader.aborted = True
+        try:
+            self.writer.close()
+        except OSError:
+            pass
+        self.thread.join()
+
+        # A genuine upload error takes precedence because it probably caused
+        # the packing to fail in the first place (broken pipe).
+        if self.error is not None and not self.reader.abortRaised:
+            raise self.error
+        return False
+
+class SimpleHttpStreamReader:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.aborted = False
+        self.abortRaised = False
+
+    def read(self, size=-1):
+        ret = self.fileobj.read(size)
+        if not ret and self.aborted:
+            self.abortRaised = True
+            raise ArtifactUploadError("aborted")
+        return ret
+
+    def close(self):
+        self.fileobj.close()
+
 
 class CustomArchive(BaseArchive):
     """Custom command archive"""
@@ -949,12 +1496,11 @@ class CustomArchive(BaseArchive):
         super().__init__(spec)
         self.__downloadCmd = spec.get("download")
         self.__uploadCmd = spec.get("upload")
-        self.__whiteList = whiteList
+        self.__env = { k:os.environ[k] for k in whiteList if k in os.environ }
 
     def _makeUrl(self, buildId, suffix):
-        packageResultId = buildIdToName(buildId)
-        return "/".join([packageResultId[0:2], packageResultId[2:4],
-            packageResultId[4:] + suffix])
+        (level1, level2, name) = buildIdToParts(buildId)
+        return "/".join([level1, level2, name + suffix])
 
     def _remoteName(self, buildId, suffix):
         return self._makeUrl(buildId, suffix)
@@ -970,7 +1516,7 @@ class CustomArchive(BaseArchive):
         url = self._makeUrl(buildId, suffix)
         try:
             os.close(tmpFd)
-            env = { k:v for (k,v) in os.environ.items() if k in self.__whiteList }
+            env = self.__env.copy()
             env["BOB_LOCAL_ARTIFACT"] = tmpName
             env["BOB_REMOTE_ARTIFACT"] = url
             ret = subprocess.call([getBashPath(), "-ec", self.__downloadCmd],
@@ -987,9 +1533,8 @@ class CustomArchive(BaseArchive):
 
     def _openUploadFile(self, buildId, suffix, overwrite):
         (tmpFd, tmpName) = mkstemp()
-        os.close(tmpFd)
-        return CustomUploader(tmpName, self._makeUrl(buildId, suffix), self.__whiteList,
-            self.__uploadCmd, overwrite)
+        return CustomUploader(tmpName, os.fdopen(tmpFd, "wb"), self._makeUrl(buildId, suffix),
+            self.__env, self.__uploadCmd, overwrite)
 
 class CustomDownloader:
     def __init__(self, name):
@@ -1001,20 +1546,23 @@ class CustomDownloader:
         return False
 
 class CustomUploader:
-    def __init__(self, name, remoteName, whiteList, uploadCmd, overwrite):
+    def __init__(self, name, tmp, remoteName, env, uploadCmd, overwrite):
         self.name = name
+        self.tmp = tmp
         self.remoteName = remoteName
-        self.whiteList = whiteList
+        self.env = env
         self.uploadCmd = uploadCmd
         self.overwrite = overwrite
 
     def __enter__(self):
-        return (self.name, None)
+        return (None, self.tmp)
 
     def __exit__(self, exc_type, exc_value, traceback):
         try:
+            # Must be flushed and closed before the command reads the file
+            self.tmp.close()
             if exc_type is None:
-                env = { k:v for (k,v) in os.environ.items() if k in self.whiteList }
+                env = self.env.copy()
                 env["BOB_LOCAL_ARTIFACT"] = self.name
                 env["BOB_REMOTE_ARTIFACT"] = self.remoteName
                 if self.overwrite:
@@ -1065,9 +1613,8 @@ class AzureArchive(BaseArchive):
 
     @staticmethod
     def __makeBlobName(buildId, suffix):
-        packageResultId = buildIdToName(buildId)
-        return "/".join([packageResultId[0:2], packageResultId[2:4],
-            packageResultId[4:] + suffix])
+        (level1, level2, name) = buildIdToParts(buildId)
+        return "/".join([level1, level2, name + suffix])
 
     def _remoteName(self, buildId, suffix):
         return "https://{}.blob.core.windows.net/{}/{}".format(self.__account,
@@ -1125,7 +1672,7 @@ class AzureUploader:
         self.__overwrite = overwrite
 
     def __enter__(self):
-        self.__tmp = TemporaryFile()
+        self.__tmp = SpooledTemporaryFile(SPOOL_MAX_SIZE)
         return (None, self.__tmp)
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -1151,6 +1698,21 @@ class AzureUploader:
             raise ArtifactUploadError(str(e))
 
 
+async def runAll(coros):
+    """Await all coroutines and raise the first error, if any.
+
+    The coroutines are run concurrently so that the total time is bounded by
+    the slowest one. This is only done if the UI can display concurrent step
+    actions. Otherwise they are awaited one after another.
+    """
+    if not isParallel():
+        for c in coros: await c
+        return
+
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for r in results:
+        if isinstance(r, BaseException): raise r
+
 class MultiArchive:
     def __init__(self, archives):
         self.__archives = archives
@@ -1174,11 +1736,13 @@ class MultiArchive:
         return any(i.canUpload() for i in self.__archives)
 
     async def uploadPackage(self, step, buildId, audit, content, executor=None):
-        for i in self.__archives:
-            if not i.canUpload(): continue
-            await i.uploadPackage(step, buildId, audit, content, executor=executor)
+        await runAll((
+            i.uploadPackage(step, buildId, audit, content, executor=executor)
+            for i in self.__archives if i.canUpload()))
 
     async def downloadPackage(self, step, buildId, audit, content, executor=None):
+        # Archives are tried strictly in order. They would all extract into
+        # the same workspace anyway.
         for i in self.__archives:
             if not i.canDownload(): continue
             caches = [ a for a in self.__archives if (a is not i) and a.canCache() ]
@@ -1187,9 +1751,9 @@ class MultiArchive:
         return False
 
     async def uploadLocalLiveBuildId(self, step, liveBuildId, buildId, executor=None):
-        for i in self.__archives:
-            if not i.canUpload(): continue
-            await i.uploadLocalLiveBuildId(step, liveBuildId, buildId, executor=executor)
+        await runAll((
+            i.uploadLocalLiveBuildId(step, liveBuildId, buildId, executor=executor)
+            for i in self.__archives if i.canUpload()))
 
     async def downloadLocalLiveBuildId(self, step, liveBuildId, executor=None):
         ret = None
@@ -1200,9 +1764,9 @@ class MultiArchive:
         return ret
 
     async def uploadLocalFingerprint(self, step, key, fingerprint, executor=None):
-        for i in self.__archives:
-            if not i.canUpload(): continue
-            await i.uploadLocalFingerprint(step, key, fingerprint, executor=executor)
+        await runAll((
+            i.uploadLocalFingerprint(step, key, fingerprint, executor=executor)
+            for i in self.__archives if i.canUpload()))
 
     async def downloadLocalFingerprint(self, step, key, executor=None):
         ret = None
@@ -2867,6 +2867,9 @@ class ArchiveValidator:
         httpArchive = baseArchive.copy()
         httpArchive["url"] = HttpUrlValidator()
         httpArchive[schema.Optional("sslVerify")] = bool
+        httpArchive[schema.Optional("chunkedUpload")] = bool
+        httpArchive[schema.Optional("timeout")] = schema.And(schema.Or(int, float),
+            lambda t: not isinstance(t, bool) and t > 0, error="Invalid timeout")
         shellArchive = baseArchive.copy()
         shellArchive.update({
             schema.Optional('download') : str,
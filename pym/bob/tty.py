@@ -557,6 +557,10 @@ def stepAction(step, action, message, severity=-2, details=""):
 def stepExec(step, action, message, severity=-2, details=""):
     return __tui.stepExec(step, action, message, severity, details)
 
+def isParallel():
+    """Can the current UI show multiple step actions at the same time?"""
+    return not isinstance(__tui, SingleTUI)
+
 def setVerbosity(verbosity):
     verbosity = max(ALWAYS, min(TRACE, verbosity))
     __tui.setVerbosity(verbosity)
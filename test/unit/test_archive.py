@@ -11,11 +11,14 @@ import asyncio
 import base64
 import http.server
 import os, os.path
+import shutil
+import socket
 import socketserver
 import stat
 import subprocess
 import tarfile
 import threading
+import time
 import urllib.parse
 import sys
 
@@ -432,6 +435,22 @@ class BaseTester:
         archive.wantUploadJenkins(True)
         self.__testUploadNoFail(archive)
 
+    @skipIf(shutil.which("gzip") is None, "requires gzip")
+    def testUploadPigz(self):
+        """Artifacts are compressed by pigz if available"""
+        archive = self.__getArchiveInstance({})
+        archive.wantUploadLocal(True)
+
+        # gzip understands the pigz options that are used. The upload must be
+        # done in-process for the patch to be effective.
+        executor = self.executor
+        self.executor = None
+        try:
+            with patch('bob.archive.getPigzPath', return_value=shutil.which("gzip")):
+                self.__testUploadNormal(archive)
+        finally:
+            self.executor = executor
+
     def testDisabled(self):
         """Test that nothing is done if up/download is disabled"""
 
@@ -470,10 +489,13 @@ class TestDummyArchive(TestCase):
         run(DummyArchive().uploadLocalFingerprint(DummyStep(), b'\x00'*20, b'\x00'*20))
 
 
-def createHttpHandler(repoPath, username=None, password=None):
+def createHttpHandler(repoPath, username=None, password=None, keepAlive=False):
 
     class Handler(http.server.BaseHTTPRequestHandler):
 
+        if keepAlive:
+            protocol_version = "HTTP/1.1"
+
         def getCommon(self):
             if username is not None:
                 challenge = 'Basic ' + base64.b64encode(
@@ -496,9 +518,15 @@ def createHttpHandler(repoPath, username=None, password=None):
 
             self.send_response(200)
             self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
             self.end_headers()
             return f
 
+        def sendStatus(self, code):
+            self.send_response(code)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
         def do_HEAD(self):
             f = self.getCommon()
             if f: f.close()
@@ -510,29 +538,34 @@ def createHttpHandler(repoPath, username=None, password=None):
                 f.close()
 
         def do_PUT(self):
-            length = int(self.headers['Content-Length'])
-            content  = self.rfile.read(length)
+            if self.headers.get('Transfer-Encoding') == "chunked":
+                content = b''
+                while True:
+                    length = int(self.rfile.readline().split(b';')[0], 16)
+                    content += self.rfile.read(length)
+                    self.rfile.readline()
+                    if length == 0: break
+            else:
+                length = int(self.headers['Content-Length'])
+                content  = self.rfile.read(length)
 
             exists = False
             path = repoPath + self.path
             if os.path.exists(path):
                 if "If-None-Match" in self.headers:
-                    self.send_response(412)
-                    self.end_headers()
+                    self.sendStatus(412)
                     return
                 else:
                     exists = True
 
             if not os.path.isdir(os.path.dirname(path)):
-                self.send_response(409)
-                self.end_headers()
+                self.sendStatus(409)
                 return
 
             try:
                 with open(path, "wb") as f:
                     f.write(content)
-                self.send_response(200 if exists else 201)
-                self.end_headers()
+                self.sendStatus(200 if exists else 201)
             except OSError:
                 self.send_error(500, "internal error")
 
@@ -540,24 +573,21 @@ def createHttpHandler(repoPath, username=None, password=None):
             path = repoPath + self.path
 
             if os.path.exists(path):
-                self.send_response(405)
-                self.end_headers()
+                self.sendStatus(405)
                 return
 
             path = path.rstrip("/")
 
             parent, _ = os.path.split(path)
             if not os.path.isdir(parent):
-                self.send_response(409)
-                self.end_headers()
+                self.sendStatus(409)
                 return
 
             try:
                 os.mkdir(path)
-                self.send_response(201)
+                self.sendStatus(201)
             except OSError:
-                self.send_response(403)
-            self.end_headers()
+                self.sendStatus(403)
 
     return Handler
 
@@ -567,6 +597,177 @@ class TestLocalArchive(BaseTester, TestCase):
         spec['backend'] = "file"
         spec["path"] = self.repo.name
 
+    @skipIf(sys.platform.startswith("win"), "requires POSIX platform")
+    def testManyFiles(self):
+        """Round trip of a workspace with many files, links and big files"""
+        archive = getArchiver(DummyRecipeSet({ 'backend' : 'file', 'path' : self.repo.name }))
+        archive.wantDownloadLocal(True)
+        archive.wantUploadLocal(True)
+
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            for i in range(100):
+                d = os.path.join(content, "dir{}".format(i % 7))
+                os.makedirs(d, exist_ok=True)
+                with open(os.path.join(d, "file{}".format(i)), "wb") as f:
+                    f.write(str(i).encode() * i)
+            big = os.urandom(3 * 1024 * 1024)
+            with open(os.path.join(content, "big"), "wb") as f:
+                f.write(big)
+            os.chmod(os.path.join(content, "dir1", "file1"), 0o755)
+            os.link(os.path.join(content, "dir3", "file3"), os.path.join(content, "hardlink"))
+            os.symlink("dir2/file2", os.path.join(content, "symlink"))
+
+            run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit,
+                                      content, executor=self.executor))
+            download = os.path.join(tmp, "download")
+            self.assertTrue(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                os.path.join(tmp, "audit2.json.gz"), download, executor=self.executor)))
+
+            for i in range(100):
+                with open(os.path.join(download, "dir{}".format(i % 7), "file{}".format(i)), "rb") as f:
+                    self.assertEqual(f.read(), str(i).encode() * i)
+            with open(os.path.join(download, "big"), "rb") as f:
+                self.assertEqual(f.read(), big)
+            self.assertEqual(os.stat(os.path.join(download, "dir1", "file1")).st_mode & 0o777, 0o755)
+            self.assertTrue(os.path.samefile(os.path.join(download, "dir3", "file3"),
+                                             os.path.join(download, "hardlink")))
+            self.assertEqual(os.readlink(os.path.join(download, "symlink")), "dir2/file2")
+
+    def testAttributeErrorsIgnored(self):
+        """Failing to restore file attributes does not fail the download"""
+        archive = getArchiver(DummyRecipeSet({ 'backend' : 'file', 'path' : self.repo.name }))
+        archive.wantDownloadLocal(True)
+
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            # Must be extracted in-process for the patch to be effective
+            with patch('os.utime', side_effect=PermissionError("denied")):
+                self.assertTrue(run(archive.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                    audit, content, executor=None)))
+            with open(os.path.join(content, "data"), "rb") as f:
+                self.assertEqual(f.read(), b'DATA')
+
+    def testDownloadCache(self):
+        """Downloaded artifacts are stored in caching archives"""
+        with TemporaryDirectory() as cache, TemporaryDirectory() as tmp:
+            recipes = DummyRecipeSet([
+                { 'backend' : 'file', 'path' : self.repo.name, 'flags' : ['download'] },
+                { 'backend' : 'file', 'path' : cache, 'flags' : ['cache'] },
+            ])
+            archive = getArchiver(recipes)
+            archive.wantDownloadLocal(True)
+
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            self.assertTrue(run(archive.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                audit, content, executor=self.executor)))
+
+            bid = hexlify(DOWNLOAD_ARITFACT).decode("ascii")
+            with open(os.path.join(cache, bid[0:2], bid[2:4], bid[4:] + "-1.tgz"), "rb") as f:
+                cached = f.read()
+            with open(self.dummyFileName, "rb") as f:
+                self.assertEqual(cached, f.read())
+
+            # Local to local caching just links the file. Not done on Windows.
+            if not sys.platform.startswith("win"):
+                self.assertTrue(os.path.samefile(self.dummyFileName,
+                    os.path.join(cache, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")))
+
+    @skipIf(sys.platform.startswith("win"), "requires POSIX platform")
+    def testDownloadCacheFileMode(self):
+        """Caching archives with a file mode get a copy"""
+        with TemporaryDirectory() as cache, TemporaryDirectory() as tmp:
+            recipes = DummyRecipeSet([
+                { 'backend' : 'file', 'path' : self.repo.name, 'flags' : ['download'] },
+                { 'backend' : 'file', 'path' : cache, 'flags' : ['cache'], 'fileMode' : 0o640 },
+            ])
+            archive = getArchiver(recipes)
+            archive.wantDownloadLocal(True)
+
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            self.assertTrue(run(archive.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                audit, content, executor=self.executor)))
+
+            bid = hexlify(DOWNLOAD_ARITFACT).decode("ascii")
+            cached = os.path.join(cache, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+            self.assertFalse(os.path.samefile(self.dummyFileName, cached))
+            self.assertEqual(os.stat(cached).st_mode & 0o777, 0o640)
+            with open(cached, "rb") as f, open(self.dummyFileName, "rb") as g:
+                self.assertEqual(f.read(), g.read())
+
+    def testExistenceCache(self):
+        """Known existing and missing artifacts are not looked up again"""
+        archive = getArchiver(DummyRecipeSet({ 'backend' : 'file', 'path' : self.repo.name }))
+        archive.wantDownloadLocal(True)
+        archive.wantUploadLocal(True)
+
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            os.mkdir(content)
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(b"DATA")
+
+            bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+            name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+
+            # Artifact is still known to be missing after it was created by
+            # someone else.
+            self.assertFalse(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                audit, content, executor=self.executor)))
+            os.makedirs(os.path.dirname(name))
+            shutil.copy(self.dummyFileName, name)
+            self.assertFalse(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                audit, content, executor=self.executor)))
+            os.unlink(name)
+
+            # Once uploaded, the artifact is not uploaded again
+            run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit,
+                                      content, executor=self.executor))
+            self.assertTrue(os.path.exists(name))
+            os.unlink(name)
+            run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit,
+                                      content, executor=self.executor))
+            self.assertFalse(os.path.exists(name))
+
+    def testUploadMultiParallel(self):
+        """Uploads to multiple archives are done concurrently"""
+        with TemporaryDirectory() as repo2, TemporaryDirectory() as tmp:
+            recipes = DummyRecipeSet([
+                { 'backend' : 'file', 'path' : self.repo.name },
+                { 'backend' : 'file', 'path' : repo2 },
+            ])
+            archive = getArchiver(recipes)
+            archive.wantUploadLocal(True)
+
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            os.mkdir(content)
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(b"DATA")
+
+            with patch('bob.archive.isParallel', return_value=True):
+                run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit,
+                                          content, executor=self.executor))
+                with self.assertRaises(BuildError):
+                    run(archive.uploadPackage(DummyStep(), ERROR_UPLOAD_ARTIFACT,
+                                              audit, content, executor=self.executor))
+
+            bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+            for r in (self.repo.name, repo2):
+                self.assertTrue(os.path.exists(os.path.join(r, bid[0:2], bid[2:4],
+                                                            bid[4:] + "-1.tgz")))
+
 
 class TestHttpArchive(BaseTester, TestCase):
 
@@ -599,6 +800,154 @@ class TestHttpArchive(BaseTester, TestCase):
         run(archive.downloadPackage(DummyStep(), b'\x00'*20, "unused", "unused", executor=self.executor))
         self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), b'\x00'*20, executor=self.executor)), None)
 
+    def testStalledServer(self):
+        """Downloads from a server that never answers time out"""
+
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            s.listen(4)
+            spec = { 'url' : "http://{}:{}".format(*s.getsockname()),
+                     'timeout' : 0.5 }
+            archive = SimpleHttpArchive(spec)
+            archive.wantDownloadLocal(True)
+
+            self.assertFalse(run(archive.downloadPackage(DummyStep(), b'\x00'*20,
+                "unused", "unused", executor=self.executor)))
+            self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(),
+                b'\x00'*20, executor=self.executor)), None)
+
+    def testParentDirCache(self):
+        """Created collections are remembered but recreated if they vanish"""
+        spec = {}
+        self._setArchiveSpec(spec)
+        archive = SimpleHttpArchive(spec)
+        archive.wantUploadLocal(True)
+
+        bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+        name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.buildid")
+
+        mkcol = SimpleHttpArchive._SimpleHttpArchive__mkcol
+        with patch.object(SimpleHttpArchive, "_SimpleHttpArchive__mkcol",
+                          autospec=True, side_effect=mkcol) as m:
+            run(archive.uploadLocalLiveBuildId(DummyStep(), UPLOAD1_ARTIFACT, b'\x01'*20))
+            calls = m.call_count
+            self.assertGreater(calls, 0)
+            os.unlink(name)
+            run(archive.uploadLocalLiveBuildId(DummyStep(), UPLOAD1_ARTIFACT, b'\x02'*20))
+            self.assertEqual(m.call_count, calls)
+
+            shutil.rmtree(os.path.join(self.repo.name, bid[0:2]))
+            run(archive.uploadLocalLiveBuildId(DummyStep(), UPLOAD1_ARTIFACT, b'\x03'*20))
+            self.assertGreater(m.call_count, calls)
+
+        with open(name, "rb") as f:
+            self.assertEqual(f.read(), b'\x03'*20)
+
+    def testStalledDownloadError(self):
+        """Extraction errors are not delayed by a stalled download"""
+        release = threading.Event()
+
+        def serve(s):
+            conn, _ = s.accept()
+            with conn:
+                conn.recv(65536)
+                conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 10000000\r\n\r\n"
+                             + b"x" * (1024 * 1024 + 10))
+                release.wait(30)
+
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            s.listen(1)
+            server = threading.Thread(target=serve, args=(s,), daemon=True)
+            server.start()
+            spec = { 'url' : "http://{}:{}".format(*s.getsockname()) }
+            archive = SimpleHttpArchive(spec)
+            archive.wantDownloadLocal(True)
+
+            try:
+                with TemporaryDirectory() as tmp:
+                    start = time.monotonic()
+                    with self.assertRaises(BuildError):
+                        run(archive.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                            os.path.join(tmp, "audit.json.gz"),
+                            os.path.join(tmp, "workspace")))
+                    self.assertLess(time.monotonic() - start, 10)
+            finally:
+                release.set()
+                server.join()
+
+class TestHttpChunkedArchive(TestHttpArchive):
+
+    def _setArchiveSpec(self, spec):
+        super()._setArchiveSpec(spec)
+        spec["chunkedUpload"] = True
+
+    def testParentDirCache(self):
+        self.skipTest("Streamed uploads always create the parent collections")
+
+    def testAbortedUpload(self):
+        """A failed packing must not leave a truncated artifact behind"""
+        spec = {}
+        self._setArchiveSpec(spec)
+        archive = SimpleHttpArchive(spec)
+        archive.wantUploadLocal(True)
+
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            os.mkdir(content)
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(os.urandom(4*1024*1024))
+
+            with patch('bob.archive.tarfile.TarFile.close', side_effect=tarfile.TarError("boom")):
+                with self.assertRaises(BuildError):
+                    run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit, content))
+
+        bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+        self.assertFalse(os.path.exists(os.path.join(self.repo.name, bid[0:2],
+                                                     bid[2:4], bid[4:] + "-1.tgz")))
+
+class CountingTCPServer(socketserver.ThreadingTCPServer):
+    connections = 0
+
+    def get_request(self):
+        ret = super().get_request()
+        self.connections += 1
+        return ret
+
+class TestHttpKeepAliveArchive(TestHttpArchive):
+
+    def setUp(self):
+        BaseTester.setUp(self)
+        self.httpd = CountingTCPServer(("localhost", 0),
+            createHttpHandler(self.repo.name, keepAlive=True))
+        self.httpd.daemon_threads = True
+        self.ip, self.port = self.httpd.server_address
+        self.server = threading.Thread(target=self.httpd.serve_forever)
+        self.server.daemon = True
+        self.server.start()
+
+    def testConnectionReuse(self):
+        """Consecutive transfers reuse the same connection"""
+        spec = {}
+        self._setArchiveSpec(spec)
+        archive = SimpleHttpArchive(spec)
+        archive.wantDownloadLocal(True)
+
+        # Trailing data after the end of the tar archive must be skipped
+        with open(self.dummyFileName, "ab") as f:
+            f.write(b'\x00' * 30000)
+
+        for i in range(3):
+            self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), DOWNLOAD_ARITFACT)), b'\x00'*20)
+            with TemporaryDirectory() as tmp:
+                audit = os.path.join(tmp, "audit.json.gz")
+                content = os.path.join(tmp, "workspace")
+                self.assertTrue(run(archive.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT, audit, content)))
+        self.assertEqual(self.httpd.connections, 1)
+
 class TestHttpBasicAuthArchive(BaseTester, TestCase):
 
     USERNAME = "bob"